@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+PTB-XL ECG Processor Benchmarks
+===============================
+
+asv-style benchmark runs for ptbxl_ecg_processor.py with stored baselines
+and a regression gate.
+
+Benchmarks:
+- synthesis.<CODE>      generate_diagnostic_ecg for every target category
+- synthesis_jit.<CODE>  the same with the Numba wave kernel (only when numba
+                        is installed), followed by a per-category speedup table
+- render.12_lead        one full plot_12_lead_ecg render
+- render.answer_key     plot_12_lead_ecg saving a clean and an annotated image
+- render.<layout>       one render in each of the other ECG_LAYOUTS
+- augment.batch         augment_signals over a batch of --augment-records signals
+- selection.filter      filter_ecgs_by_category on a 21,799-row sample table
+- quiz.bank             write_quiz_bank streaming questions for --quiz-records ECGs
+- pipeline.run          end-to-end run() in synthetic mode
+- startup.import_quiz   fresh-interpreter import plus quiz-only generation,
+                        gated by an absolute --import-target as well
+
+Usage:
+    python ptbxl_benchmark.py                    # compare against the stored baseline
+    python ptbxl_benchmark.py --save-baseline    # record a new baseline
+    python ptbxl_benchmark.py --only synthesis --threshold 0.10
+
+Exits with status 1 when any benchmark is slower than its baseline by more
+than the threshold (default 20%).
+"""
+
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import contextlib
+
+import numpy as np
+
+from ptbxl_ecg_processor import (
+    PTBXLECGProcessor, ECGRecord, ECG_LAYOUTS, augment_signals, beat_annotations, wave_kernel
+)
+
+DEFAULT_BASELINE = os.path.join('.benchmarks', 'ptbxl_baseline.json')
+PTBXL_RECORD_COUNT = 21799
+
+# Modules that must stay out of a quiz-only import
+HEAVY_MODULES = ['pandas', 'matplotlib', 'wfdb', 'requests', 'tqdm']
+
+STARTUP_SCRIPT = '''
+import io, sys, json, tempfile, contextlib
+import numpy as np
+
+from ptbxl_ecg_processor import PTBXLECGProcessor
+workspace = tempfile.mkdtemp()
+processor = PTBXLECGProcessor(base_dir=workspace, output_dir=workspace)
+metadata = [
+    {'id': f'{code}_{i + 1}', 'category': code, 'diagnosis': name,
+     'image_path': f'/ecg/ptbxl_12lead/{code.lower()}_{i + 1}.png',
+     'age': 30 + i * 10, 'sex': i % 2, 'probability': 100.0}
+    for code, name in processor.target_categories.items() for i in range(5)
+]
+with contextlib.redirect_stdout(io.StringIO()):
+    processor.generate_quiz_questions(metadata)
+print(json.dumps([name for name in json.loads(sys.argv[1]) if name in sys.modules]))
+'''
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silence the processor's progress output while timing"""
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+class BenchmarkContext:
+    """Temporary processor workspaces shared by the benchmarks"""
+
+    def __init__(self, args):
+        self.args = args
+        self.root = tempfile.mkdtemp(prefix='ptbxl_bench_')
+        self._processors = {}
+        self.targets = {}  # benchmark name -> absolute limit in seconds
+
+    def processor(self, name, categories=None, num_records=None, layout='3x4', jit=False):
+        """Create (once) a processor in its own workspace, optionally seeded with sample data"""
+        if name not in self._processors:
+            workspace = os.path.join(self.root, name)
+            processor = PTBXLECGProcessor(
+                base_dir=os.path.join(workspace, 'data'),
+                output_dir=os.path.join(workspace, 'output'),
+                derive_limb_leads=self.args.derive_limb_leads,
+                layout=layout,
+                jit=jit
+            )
+            if categories:
+                processor.target_categories = {
+                    code: processor.target_categories[code] for code in categories
+                }
+            if num_records:
+                with quiet():
+                    processor.create_sample_metadata(num_records, seed=0)
+                    processor.create_sample_statements()
+            self._processors[name] = processor
+        return self._processors[name]
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def collect_benchmarks(ctx):
+    """Build the list of (name, setup, func, repeat) benchmark cases"""
+    args = ctx.args
+    benchmarks = []
+
+    # Synthesis - one case per diagnostic category
+    synth = ctx.processor('synthesis', layout=args.synthesis_layout)
+    for code in synth.target_categories:
+        benchmarks.append((
+            f'synthesis.{code}',
+            None,
+            lambda code=code: synth.generate_diagnostic_ecg(code, {'ecg_id': 1}, 0),
+            args.repeat
+        ))
+
+    # The same records through the Numba wave kernel (compiled during warmup)
+    if wave_kernel() is not None:
+        jit = ctx.processor('synthesis_jit', layout=args.synthesis_layout, jit=True)
+        for code in jit.target_categories:
+            benchmarks.append((
+                f'synthesis_jit.{code}',
+                None,
+                lambda code=code: jit.generate_diagnostic_ecg(code, {'ecg_id': 1}, 0),
+                args.repeat
+            ))
+
+    # Full 12-lead render of a representative signal
+    def render_setup():
+        render = ctx.processor('render')
+        signal = render.generate_diagnostic_ecg('NORM', {'ecg_id': 1}, 0)
+        metadata = {'age': 60, 'sex': 1, 'heart_rate': 75}
+        return lambda: render.plot_12_lead_ecg(signal, metadata, 'benchmark.png')
+    benchmarks.append(('render.12_lead', render_setup, None, args.render_repeat))
+
+    # The same render plus its annotated answer key from the same figure
+    def answer_key_setup():
+        render = ctx.processor('render')
+        signal, info = render.generate_diagnostic_ecg('WPW', {'ecg_id': 1}, 0, return_info=True)
+        annotations = beat_annotations('WPW', info)
+        metadata = {'age': 60, 'sex': 1, 'heart_rate': 75, 'diagnosis': 'Wolff-Parkinson-White Syndrome'}
+        return lambda: render.plot_12_lead_ecg(signal, metadata, 'benchmark.png', annotations,
+                                               'benchmark_key.png')
+    benchmarks.append(('render.answer_key', answer_key_setup, None, args.render_repeat))
+
+    # The other print layouts, each synthesized at the duration it shows
+    for layout in ECG_LAYOUTS:
+        if layout == '3x4':
+            continue
+        def layout_setup(layout=layout):
+            render = ctx.processor(f'render_{layout}', layout=layout)
+            signal = render.generate_diagnostic_ecg('NORM', {'ecg_id': 1}, 0)
+            metadata = {'age': 60, 'sex': 1, 'heart_rate': 75}
+            return lambda: render.plot_12_lead_ecg(signal, metadata, 'benchmark.png')
+        benchmarks.append((f'render.{layout}', layout_setup, None, args.render_repeat))
+
+    # Batched augmentation (per-record Generators, broadcast artifacts)
+    def augment_setup():
+        signal = ctx.processor('synthesis').generate_diagnostic_ecg('NORM', {'ecg_id': 1}, 0)
+        batch = np.repeat(signal[None].astype(np.float32), args.augment_records, axis=0)
+        seeds = np.arange(args.augment_records)
+        return lambda: augment_signals(batch, seeds)
+    benchmarks.append(('augment.batch', augment_setup, None, args.repeat))
+
+    # Category selection over a table the size of the real database
+    def filter_setup():
+        selection = ctx.processor('selection', num_records=PTBXL_RECORD_COUNT)
+        with quiet():
+            selection.load_metadata()
+        return selection.filter_ecgs_by_category
+    benchmarks.append(('selection.filter', filter_setup, None, args.repeat))
+
+    # Columnar quiz bank streamed to disk
+    def quiz_setup():
+        quiz = ctx.processor('quiz')
+        codes = list(quiz.category_names)
+        metadata = [
+            ECGRecord(id=f'{codes[i % len(codes)]}_{i + 1}', ecg_id=i + 1, category=codes[i % len(codes)],
+                      diagnosis=quiz.category_names[codes[i % len(codes)]],
+                      image_path=f'/ecg/ptbxl_12lead/{codes[i % len(codes)].lower()}_{i + 1}.png',
+                      age=20 + i % 70, sex=i % 2, probability=100.0)
+            for i in range(args.quiz_records)
+        ]
+        quiz_file = os.path.join(ctx.root, 'quiz_bank.json')
+        return lambda: quiz.write_quiz_bank(metadata, quiz_file)
+    benchmarks.append(('quiz.bank', quiz_setup, None, args.repeat))
+
+    # End-to-end synthetic run on a small category subset (rendering dominates)
+    def run_setup():
+        pipeline = ctx.processor('pipeline', categories=args.run_categories,
+                                 num_records=args.run_records)
+
+        def run():
+            if not pipeline.run():
+                raise RuntimeError("pipeline.run reported a failed stage")
+        return run
+    benchmarks.append(('pipeline.run', run_setup, None, 1))
+
+    # Cold start: new interpreter importing the module and writing a quiz deck
+    def startup():
+        output = subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT, json.dumps(HEAVY_MODULES)],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout
+        loaded = json.loads(output.strip().splitlines()[-1])
+        if loaded:
+            raise RuntimeError(f"quiz-only import loaded heavy modules: {', '.join(loaded)}")
+    benchmarks.append(('startup.import_quiz', None, startup, args.repeat))
+    ctx.targets['startup.import_quiz'] = args.import_target
+
+    return benchmarks
+
+
+def time_benchmark(func, repeat, warmup):
+    """Time func() `repeat` times after `warmup` untimed calls"""
+    with quiet():
+        for _ in range(warmup):
+            func()
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            samples.append(time.perf_counter() - start)
+    return {
+        'median': statistics.median(samples),
+        'min': min(samples),
+        'max': max(samples),
+        'repeat': repeat
+    }
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, results):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    baseline = {
+        'machine': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor()
+        },
+        'recorded_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results
+    }
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2)
+
+
+def check_targets(results, targets):
+    """Return the names of benchmarks slower than their absolute target"""
+    missed = []
+    for name, target in targets.items():
+        if name in results and results[name]['median'] > target:
+            print(f"❌ {name}: {results[name]['median'] * 1000:.1f}ms exceeds target {target * 1000:.0f}ms")
+            missed.append(name)
+    return missed
+
+
+def compare(results, baseline, threshold):
+    """Print a comparison table and return the names of regressed benchmarks"""
+    regressions = []
+    print(f"\n{'benchmark':<28} {'median':>10} {'baseline':>10} {'ratio':>7}")
+    print('-' * 58)
+    for name, result in results.items():
+        reference = (baseline or {}).get('results', {}).get(name)
+        if reference is None:
+            print(f"{name:<28} {result['median'] * 1000:>8.2f}ms {'-':>10} {'new':>7}")
+            continue
+        ratio = result['median'] / reference['median'] if reference['median'] else 1.0
+        flag = ''
+        if ratio > 1.0 + threshold:
+            flag = '  ❌ regression'
+            regressions.append(name)
+        print(f"{name:<28} {result['median'] * 1000:>8.2f}ms "
+              f"{reference['median'] * 1000:>8.2f}ms {ratio:>6.2f}x{flag}")
+    return regressions
+
+
+def report_speedups(results):
+    """Print the Numba kernel's speedup over NumPy for every category timed both ways"""
+    pairs = [(name.split('.', 1)[1], results[name], results[f'synthesis_jit.{name.split(".", 1)[1]}'])
+             for name in results
+             if name.startswith('synthesis.') and f'synthesis_jit.{name.split(".", 1)[1]}' in results]
+    if not pairs:
+        return
+    print(f"\n⚡ Numba wave kernel speedup\n{'category':<10} {'numpy':>10} {'jit':>10} {'speedup':>8}")
+    print('-' * 41)
+    for code, numpy_result, jit_result in pairs:
+        print(f"{code:<10} {numpy_result['median'] * 1000:>8.2f}ms {jit_result['median'] * 1000:>8.2f}ms "
+              f"{numpy_result['median'] / jit_result['median']:>7.2f}x")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the PTB-XL ECG processor')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help=f'Baseline JSON file (default: {DEFAULT_BASELINE})')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store the results as the new baseline instead of comparing')
+    parser.add_argument('--threshold', type=float, default=0.20,
+                        help='Allowed slowdown relative to baseline before failing (0.20 = 20%%)')
+    parser.add_argument('--only', action='append', default=[],
+                        help='Run only benchmarks whose name starts with this prefix (repeatable)')
+    parser.add_argument('--repeat', type=int, default=7,
+                        help='Timed repetitions for fast benchmarks')
+    parser.add_argument('--render-repeat', type=int, default=3,
+                        help='Timed repetitions for the render benchmark')
+    parser.add_argument('--warmup', type=int, default=1,
+                        help='Untimed warmup calls per benchmark')
+    parser.add_argument('--run-categories', type=lambda s: s.split(','), default=['NORM', 'AFIB'],
+                        help='Comma-separated categories for the end-to-end run benchmark')
+    parser.add_argument('--derive-limb-leads', action='store_true',
+                        help='Benchmark synthesis with limb leads derived from I and II')
+    parser.add_argument('--synthesis-layout', choices=sorted(ECG_LAYOUTS), default='3x4',
+                        help='Layout whose strip length the synthesis benchmarks generate (default: 3x4)')
+    parser.add_argument('--import-target', type=float, default=0.5,
+                        help='Absolute limit in seconds for startup.import_quiz')
+    parser.add_argument('--augment-records', type=int, default=1000,
+                        help='Signals per batch in the augmentation benchmark')
+    parser.add_argument('--quiz-records', type=int, default=50000,
+                        help='ECGs in the quiz bank benchmark (two questions each)')
+    parser.add_argument('--run-records', type=int, default=200,
+                        help='Sample metadata rows for the end-to-end run benchmark')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    ctx = BenchmarkContext(args)
+    results = {}
+
+    try:
+        for name, setup, func, repeat in collect_benchmarks(ctx):
+            if args.only and not any(name.startswith(prefix) for prefix in args.only):
+                continue
+            print(f"⏱️  {name}...")
+            if setup is not None:
+                with quiet():
+                    func = setup()
+            warmup = args.warmup if repeat > 1 else 0
+            results[name] = time_benchmark(func, repeat, warmup)
+    finally:
+        ctx.cleanup()
+
+    if args.save_baseline:
+        compare(results, None, args.threshold)
+        report_speedups(results)
+        if check_targets(results, ctx.targets):
+            return 1
+        save_baseline(args.baseline, results)
+        print(f"\n💾 Baseline saved to: {args.baseline}")
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        print(f"\n⚠️  No baseline at {args.baseline} - run with --save-baseline first")
+    regressions = compare(results, baseline, args.threshold)
+    report_speedups(results)
+    missed_targets = check_targets(results, ctx.targets)
+
+    if regressions:
+        print(f"\n❌ {len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}")
+    if regressions or missed_targets:
+        return 1
+
+    print("\n✅ No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
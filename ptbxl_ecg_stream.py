@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+PTB-XL Synthetic ECG Stream
+===========================
+
+Continuous 12-lead ECG synthesis for the live monitor view. Uses the same
+beat morphology and RR intervals as ptbxl_ecg_processor.generate_diagnostic_ecg,
+but renders beats into a sliding window instead of a whole-record buffer, so a
+stream can run indefinitely and change rhythm mid-stream (e.g. AFIB turning
+into VF).
+
+State kept between chunks is O(1): the RNG, the current category parameters,
+the next beat onset and a one-second carry buffer holding the tails of beats
+that overlap the next chunk.
+
+Usage:
+python ptbxl_ecg_stream.py --category AFIB --chunks 200          # latency benchmark
+python ptbxl_ecg_stream.py --serve --port 8765                   # local stream server
+python ptbxl_ecg_stream.py --connect --port 8765 --chunks 20 --switch VF@4
+
+The server speaks newline-delimited JSON over TCP as a stand-in for a
+WebSocket: one {"type": "chunk", ...} message per chunk, and clients may send
+{"category": "VF"} at any time to switch rhythm. Unknown category codes are
+answered with an {"type": "error", ...} message and leave the rhythm unchanged.
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+import numpy as np
+
+from ptbxl_ecg_processor import (
+    INDEPENDENT_LEADS, LIMB_LEAD_MATRIX, SCP_HIERARCHY, stable_hash,
+    synthesis_parameters, add_beat, next_rr_interval
+)
+
+LEAD_NAMES = ['I', 'II', 'III', 'aVR', 'aVL', 'aVF', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6']
+
+# How far a beat's waves reach around its onset, in seconds. VF chaos starts
+# one RR interval before the QRS (>= -0.14 s); AFib fibrillation runs for
+# 0.9 RR at >= 90 bpm (<= 0.6 s) and T waves end 0.425 s after onset.
+BEAT_LOOKBEHIND = 0.2
+BEAT_LOOKAHEAD = 0.8
+
+
+class ECGStream:
+    """
+    Indefinite 12-lead ECG generator yielding fixed-size chunks
+
+    Beats are placed once their whole waveform fits in the current chunk plus
+    the carry window, then the window slides forward by one chunk.
+    """
+
+    def __init__(self, category_code='NORM', chunk_size=250, sampling_rate=500,
+                 seed=0, derive_limb_leads=False):
+        """
+        Args:
+            category_code: Initial diagnostic category
+            chunk_size: Samples per chunk (250 = 0.5 s at 500 Hz)
+            sampling_rate: Samples per second
+            seed: Stream seed; equal seeds and switch points give equal streams
+            derive_limb_leads: Synthesize I, II, V1-V6 and derive the other limb leads
+        """
+        self.chunk_size = chunk_size
+        self.sampling_rate = sampling_rate
+        self.derive_limb_leads = derive_limb_leads
+        self.synthesized_leads = INDEPENDENT_LEADS if derive_limb_leads else LEAD_NAMES
+        self.rng = np.random.RandomState(stable_hash(f"stream_{seed}") % 2**32)
+
+        self.horizon = int(np.ceil((BEAT_LOOKBEHIND + BEAT_LOOKAHEAD) * sampling_rate))
+        self.carry = np.zeros((len(self.synthesized_leads), self.horizon))
+        self.position = 0  # Samples emitted so far
+        self.next_beat = 0.2  # Onset of the next unscheduled beat (s)
+        self._time_axes = {}
+        self.set_category(category_code)
+
+    def set_category(self, category_code):
+        """Switch rhythm; beats not yet placed use the new category"""
+        if not isinstance(category_code, str) or category_code not in SCP_HIERARCHY:
+            raise ValueError(f"Unknown category code: {category_code}")
+        self.category_code = category_code
+        self.params = synthesis_parameters(category_code, self.rng)
+        self.rr_interval = 60 / self.params['heart_rate']
+
+    @property
+    def elapsed(self):
+        """Stream time in seconds at the start of the next chunk"""
+        return self.position / self.sampling_rate
+
+    def _time_axis(self, length):
+        if length not in self._time_axes:
+            self._time_axes[length] = np.arange(length) / self.sampling_rate
+        return self._time_axes[length]
+
+    def next_chunk(self, size=None):
+        """
+        Synthesize the next chunk
+
+        Args:
+            size: Samples in this chunk (default: self.chunk_size)
+
+        Returns:
+            (size x 12) array in standard lead order
+        """
+        size = size or self.chunk_size
+        start = self.elapsed
+        window = np.zeros((len(self.synthesized_leads), size + self.horizon))
+        window[:, :self.horizon] = self.carry
+        t = self._time_axis(window.shape[1])
+
+        # Place every beat whose waveform ends inside the window
+        last_onset = start + window.shape[1] / self.sampling_rate - BEAT_LOOKAHEAD
+        while self.next_beat <= last_onset:
+            onset = self.next_beat - start
+            for lead, lead_name in enumerate(self.synthesized_leads):
+                add_beat(window[lead], t, onset, lead_name, self.category_code,
+                         self.params, self.rng, self.sampling_rate)
+            self.next_beat += next_rr_interval(self.category_code, self.rr_interval, self.rng)
+
+        self.carry = window[:, size:].copy()
+        chunk = window[:, :size]
+        chunk += self.rng.normal(0, self.params['base_amplitude'] * 0.01, chunk.shape)
+        self.position += size
+
+        chunk = chunk.T
+        if self.derive_limb_leads:
+            return chunk @ LIMB_LEAD_MATRIX
+        return np.ascontiguousarray(chunk)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next_chunk()
+
+    async def chunks(self, realtime=True, count=None):
+        """
+        Async iterator over chunks
+
+        Args:
+            realtime: Pace chunks to wall-clock time (chunk_size / sampling_rate apart)
+            count: Stop after this many chunks (None = forever)
+        """
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        emitted = 0
+        while count is None or emitted < count:
+            if realtime:
+                due = started + emitted * self.chunk_size / self.sampling_rate
+                await asyncio.sleep(max(0.0, due - loop.time()))
+            else:
+                await asyncio.sleep(0)
+            yield self.next_chunk()
+            emitted += 1
+
+
+def chunk_message(stream, seq, chunk, start):
+    """One newline-terminated JSON chunk message (lead-major sample lists)"""
+    return (json.dumps({
+        'type': 'chunk',
+        'seq': seq,
+        'start': round(start, 6),
+        'category': stream.category_code,
+        'sampling_rate': stream.sampling_rate,
+        'leads': LEAD_NAMES,
+        'data': np.round(chunk.T, 4).tolist()
+    }) + '\n').encode('utf-8')
+
+
+async def serve(host='127.0.0.1', port=8765, category_code='NORM', chunk_size=250,
+                seed=0, derive_limb_leads=False, realtime=True):
+    """
+    Local stand-in for the monitor WebSocket: one ECGStream per connection
+
+    Args:
+        host, port: Address to listen on
+        category_code, chunk_size, seed, derive_limb_leads: ECGStream settings
+        realtime: Pace chunks to wall-clock time
+    """
+    async def handle(reader, writer):
+        stream = ECGStream(category_code, chunk_size, seed=seed,
+                           derive_limb_leads=derive_limb_leads)
+
+        def reply_error(text):
+            writer.write((json.dumps({'type': 'error', 'message': text}) + '\n').encode('utf-8'))
+
+        async def commands():
+            async for line in reader:
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(message, dict):
+                    reply_error(f"Expected a JSON object, got: {line.decode('utf-8', 'replace').strip()}")
+                    continue
+                if message.get('category'):
+                    try:
+                        stream.set_category(message['category'])
+                    except ValueError as e:
+                        reply_error(str(e))
+
+        listener = asyncio.ensure_future(commands())
+        try:
+            seq = 0
+            async for chunk in stream.chunks(realtime=realtime):
+                writer.write(chunk_message(stream, seq, chunk,
+                                           stream.elapsed - len(chunk) / stream.sampling_rate))
+                await writer.drain()
+                seq += 1
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            listener.cancel()
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f"📡 Streaming {category_code} on {host}:{port} "
+          f"({chunk_size} samples/chunk at 500 Hz)")
+    async with server:
+        await server.serve_forever()
+
+
+async def consume(host='127.0.0.1', port=8765, count=20, switches=None):
+    """
+    Read chunks from a stream server, sending category switches on the way
+
+    Args:
+        count: Chunks to receive
+        switches: List of (category_code, seconds) switch points in stream time
+
+    Returns:
+        List of decoded chunk messages
+    """
+    pending = sorted(switches or [], key=lambda switch: switch[1])
+    reader, writer = await asyncio.open_connection(host, port)
+    messages = []
+    try:
+        while len(messages) < count:
+            line = await reader.readline()
+            if not line:
+                break  # Server closed the connection
+            message = json.loads(line)
+            if message.get('type') == 'error':
+                print(f"⚠️  Server: {message['message']}")
+                continue
+            messages.append(message)
+            chunk_end = message['start'] + len(message['data'][0]) / message['sampling_rate']
+            while pending and pending[0][1] <= chunk_end:
+                code, _ = pending.pop(0)
+                writer.write((json.dumps({'category': code}) + '\n').encode('utf-8'))
+                await writer.drain()
+    finally:
+        writer.close()
+    return messages
+
+
+def benchmark(stream, count, switches=None):
+    """Time next_chunk() and report latency against the chunk duration"""
+    pending = sorted(switches or [], key=lambda switch: switch[1])
+    chunk_duration = stream.chunk_size / stream.sampling_rate
+    latencies = []
+    for _ in range(count):
+        while pending and pending[0][1] <= stream.elapsed:
+            stream.set_category(pending.pop(0)[0])
+        started = time.perf_counter()
+        stream.next_chunk()
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"⏱️  {count} chunks of {stream.chunk_size} samples ({chunk_duration * 1000:.0f}ms each)")
+    print(f"   median {statistics.median(latencies) * 1000:.2f}ms, p99 {p99 * 1000:.2f}ms, "
+          f"max {latencies[-1] * 1000:.2f}ms "
+          f"({p99 / chunk_duration:.1%} of chunk duration at p99)")
+    return latencies
+
+
+def _parse_switch(value):
+    """Parse CODE@SECONDS into (code, seconds)"""
+    code, _, seconds = value.partition('@')
+    try:
+        return code, float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected CODE@SECONDS, got '{value}'")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Stream synthetic 12-lead ECG chunks')
+    parser.add_argument('--category', default='NORM', help='Initial diagnostic category')
+    parser.add_argument('--chunk-size', type=int, default=250,
+                        help='Samples per chunk at 500 Hz (default: 250 = 0.5 s)')
+    parser.add_argument('--chunks', type=int, default=200,
+                        help='Chunks to benchmark or to receive with --connect')
+    parser.add_argument('--seed', type=int, default=0, help='Stream seed')
+    parser.add_argument('--switch', type=_parse_switch, action='append', default=[],
+                        metavar='CODE@SECONDS', help='Switch category at a stream time (repeatable)')
+    parser.add_argument('--derive-limb-leads', action='store_true',
+                        help='Synthesize I, II, V1-V6 and derive III, aVR, aVL, aVF')
+    parser.add_argument('--serve', action='store_true', help='Run the local stream server')
+    parser.add_argument('--connect', action='store_true', help='Consume chunks from a stream server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--no-realtime', action='store_true',
+                        help='Serve chunks as fast as possible instead of at 500 Hz wall-clock pace')
+    args = parser.parse_args(argv)
+    unknown = [code for code in [args.category] + [code for code, _ in args.switch] if code not in SCP_HIERARCHY]
+    if unknown:
+        parser.error(f"Unknown category codes: {', '.join(unknown)}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.serve:
+        try:
+            asyncio.run(serve(args.host, args.port, args.category, args.chunk_size,
+                              args.seed, args.derive_limb_leads, not args.no_realtime))
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if args.connect:
+        messages = asyncio.run(consume(args.host, args.port, args.chunks, args.switch))
+        for message in messages:
+            print(f"📦 #{message['seq']:<4} t={message['start']:7.2f}s {message['category']:<6} "
+                  f"{len(message['data'][0])} samples x {len(message['leads'])} leads")
+        return 0
+
+    stream = ECGStream(args.category, args.chunk_size, seed=args.seed,
+                       derive_limb_leads=args.derive_limb_leads)
+    benchmark(stream, args.chunks, args.switch)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())